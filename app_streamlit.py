@@ -1,10 +1,13 @@
 # src/app_streamlit.py
 
 import os
+import copy
 import json
-import base64
+import logging
+import math
 from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import streamlit as st
@@ -16,11 +19,21 @@ from reportlab.rl_config import TTFSearchPath
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, LongTable, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 
+# C-ускорители ReportLab (с 4.x — отдельный пакет rl_accel); без них doc.build заметно медленнее
+try:
+    import _rl_accel  # noqa: F401
+except ImportError:
+    try:
+        from reportlab.lib import _rl_accel  # noqa: F401
+    except ImportError:
+        logging.getLogger(__name__).warning("ReportLab C accelerators (rl_accel) not found, PDF build uses pure-Python fallbacks")
+
 from src.data_loader import fetch_leads, normalize_to_df, create_task
 from src.llm_client import LLMClient
+from src.config import SETTINGS
 
 
 # ---------- helpers ----------
@@ -132,19 +145,55 @@ st.markdown(
     unsafe_allow_html=True
 )
 
-# --------- LLM client (глобально, один раз) ----------
-if "llm_client" not in st.session_state:
-    st.session_state["llm_client"] = LLMClient()
-client = st.session_state["llm_client"]
+# --------- LLM client (один на процесс, общий для всех сессий) ----------
+@st.cache_resource
+def get_llm_client() -> LLMClient:
+    return LLMClient()
+
+client = get_llm_client()
 
 # --- Controls / globals ---
 refresh_clicked = st.button("Посмотреть риски", key="refresh_btn")
 SLA_DAYS = int(os.getenv("SLA_DAYS", "2"))
+PAGE_SIZE = 20
 
 def _task_text(row: pd.Series) -> str:
     return (f"[Сделка #{row['deal_id']}] Риск: {row['risk_level']}. "
             f"Причина: {row['risk_reason']}. Действие: {row['action']}")
 
+BADGE_HTML = {level: f'<span class="badge {level}">{level.upper()}</span>' for level in ("red", "yellow", "green")}
+
+CARD_TEMPLATE = """
+    <div class="lead-card">
+      <div class="lead-head">
+        <div>
+          <div class="lead-name">{name}</div>
+          <div class="lead-sec">Последний контакт: {lc} • {sla_txt}</div>
+        </div>
+        {badge}
+      </div>
+      <div class="lead-body">
+        <b>Причина:</b> {reason}<br/>
+        <b>Действие:</b> {action}
+      </div>
+      <div class="lead-actions">
+        <a class="link-btn" href="{kommo_link}" target="_blank">Открыть в Kommo</a>
+      </div>
+    </div>
+    """
+
+def _card_html(r) -> str:
+    """HTML карточки сделки; r — строка из itertuples() с готовыми badge_html/sla_txt."""
+    return CARD_TEMPLATE.format(
+        name=r.client_name or f"Lead #{r.deal_id}",
+        lc=r.last_contact_date or "—",
+        sla_txt=r.sla_txt,
+        badge=r.badge_html,
+        reason=r.risk_reason or "—",
+        action=r.action or "—",
+        kommo_link=r.kommo or "#",
+    )
+
 def _deadline_today_18() -> int:
     now = datetime.now()
     return int(datetime(now.year, now.month, now.day, 18, 0, 0).timestamp())
@@ -152,14 +201,15 @@ def _deadline_today_18() -> int:
 # ---- fonts: лежат в src/fonts ----
 ROOT = os.path.dirname(__file__)
 FONTS_DIR = os.path.join(ROOT, "src", "fonts")
-TTFSearchPath.append(FONTS_DIR)
 FONT_REGULAR = os.path.join(FONTS_DIR, "DejaVuSans.ttf")
 FONT_BOLD    = os.path.join(FONTS_DIR, "DejaVuSans-Bold.ttf")
 
-USING_DEJAVU = False
-if not os.path.exists(FONT_REGULAR):
-    st.error(f"Не найден шрифт: {FONT_REGULAR}")
-else:
+@st.cache_resource
+def _register_fonts() -> tuple[bool, str | None]:
+    """Регистрирует DejaVu один раз на процесс. Возвращает (USING_DEJAVU, текст ошибки)."""
+    TTFSearchPath.append(FONTS_DIR)
+    if not os.path.exists(FONT_REGULAR):
+        return False, f"Не найден шрифт: {FONT_REGULAR}"
     try:
         pdfmetrics.registerFont(TTFont("DejaVu", FONT_REGULAR))
         if os.path.exists(FONT_BOLD):
@@ -174,45 +224,71 @@ else:
         addMapping('DejaVu', 0, 1, 'DejaVu-Italic')
         addMapping('DejaVu', 1, 0, 'DejaVu-Bold')
         addMapping('DejaVu', 1, 1, 'DejaVu-BoldItalic')
-        USING_DEJAVU = True
+        return True, None
     except Exception as e:
-        st.error(f"Ошибка регистрации шрифта: {e}")
-
-def get_pdf_download_link(pdf_bytes: bytes, filename: str, link_text: str = "Скачать отчёт (PDF)") -> str:
-    b64 = base64.b64encode(pdf_bytes).decode("utf-8")
-    return (
-        f'<a href="data:application/pdf;base64,{b64}" download="{filename}" '
-        f'style="display:inline-block;padding:10px 14px;border-radius:10px;'
-        f'background:#6a5cff;color:#fff;font-weight:700;text-decoration:none;">{link_text}</a>'
-    )
+        return False, f"Ошибка регистрации шрифта: {e}"
 
-def _digest_pdf(df: pd.DataFrame) -> bytes:
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(
-        buffer, pagesize=A4,
-        leftMargin=18*mm, rightMargin=18*mm, topMargin=16*mm, bottomMargin=16*mm,
-        title="Отчёт по рискам сделок"
-    )
+USING_DEJAVU, _font_error = _register_fonts()
+if _font_error:
+    st.error(_font_error)
 
+# ---- PDF styles: скрипт Streamlit перезапускается целиком, поэтому держим их в cache_resource ----
+@st.cache_resource
+def _pdf_styles(using_dejavu: bool):
     styles = getSampleStyleSheet()
-    base_font = 'DejaVu' if USING_DEJAVU else styles['Normal'].fontName
-    bold_font = 'DejaVu-Bold' if USING_DEJAVU else styles['Heading1'].fontName
+    base_font = 'DejaVu' if using_dejavu else styles['Normal'].fontName
+    bold_font = 'DejaVu-Bold' if using_dejavu else styles['Heading1'].fontName
 
     styles.add(ParagraphStyle(name="H1", fontName=bold_font, fontSize=18, leading=22, spaceAfter=8))
     styles.add(ParagraphStyle(name="H2", fontName=bold_font, fontSize=13, leading=17, spaceBefore=8, spaceAfter=6))
     styles.add(ParagraphStyle(name="P",  fontName=base_font, fontSize=10.5, leading=14))
     styles.add(ParagraphStyle(name="Small", fontName=base_font, fontSize=9, leading=12, textColor=colors.grey))
     styles.add(ParagraphStyle(name="Wrap", fontName=base_font, fontSize=9.5, leading=12.5, wordWrap='CJK'))
+    return styles, base_font
+
+_STYLES, _BASE_FONT = _pdf_styles(USING_DEJAVU)
 
-    def P(text, style="P"): return Paragraph(text, styles[style])
+def _P(text, style="P"): return Paragraph(text, _STYLES[style])
+
+@st.cache_resource
+def _pdf_table_headers(using_dejavu: bool):
+    """Заголовки таблиц отчёта: разбираем разметку один раз, в _digest_pdf только копируем."""
+    styles, _ = _pdf_styles(using_dejavu)
+    def h(text): return Paragraph(f"<b>{text}</b>", styles["P"])
+    red = [h("ID"), h("Лид"), h("Сумма, ₽"), h("Последний контакт"),
+           h("Уровень"), h("Причина"), h("Действие"), h("Kommo")]
+    yellow = [h("ID"), h("Лид"), h("Сумма, ₽"), h("Последний контакт"),
+              h("Причина"), h("Действие")]
+    return red, yellow
+
+RED_HEADER, YELLOW_HEADER = _pdf_table_headers(USING_DEJAVU)
+
+LONG_TABLE_ROWS = 50
+
+def _report_table(rows, colWidths) -> Table:
+    """Таблица отчёта; на длинных списках — LongTable, чтобы разбивка по страницам не пересчитывала всё заново."""
+    table_cls = LongTable if len(rows) > LONG_TABLE_ROWS else Table
+    return table_cls(rows, colWidths=colWidths, repeatRows=1, longTableOptimize=1, splitByRow=1)
+
+# повторные клики с теми же данными отдают готовый PDF; st.cache_data сам хэширует DataFrame
+@st.cache_data(ttl=3600, show_spinner=False)
+def _digest_pdf(df: pd.DataFrame, kpis: dict) -> bytes:
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(
+        buffer, pagesize=A4,
+        leftMargin=18*mm, rightMargin=18*mm, topMargin=16*mm, bottomMargin=16*mm,
+        title="Отчёт по рискам сделок"
+    )
+
+    styles = _STYLES
+    base_font = _BASE_FONT
+    P = _P
 
     def _fmt_money(x):
         try: return f"{int(x):,}".replace(",", " ")
         except Exception: return str(x)
 
     red = df[df["risk_level"] == "red"]
-    yellow = df[df["risk_level"] == "yellow"]
-    total_red = int(red["deal_value"].sum()) if "deal_value" in df.columns else 0
 
     elems = []
     elems.append(P("Ежедневный отчёт по рискам", "H1"))
@@ -221,7 +297,7 @@ def _digest_pdf(df: pd.DataFrame) -> bytes:
 
     kpi_data = [
         [P("<b>Красные</b>", "Small"), P("<b>Сумма сделок в красной зоне, ₽</b>", "Small"), P("<b>Жёлтые</b>", "Small")],
-        [P(str(len(red))), P(_fmt_money(total_red)), P(str(len(yellow)))]
+        [P(str(kpis["red_n"])), P(_fmt_money(kpis["red_total"])), P(str(kpis["yellow_n"]))]
     ]
     kpi_tbl = Table(kpi_data, colWidths=[55*mm, 60*mm, 40*mm])
     kpi_tbl.setStyle(TableStyle([
@@ -241,7 +317,7 @@ def _digest_pdf(df: pd.DataFrame) -> bytes:
 
     # ===== TOP-5 КРАСНЫХ =====
     elems.append(P("ТОП-5 красных сделок", "H2"))
-    top_red = red.sort_values("deal_value", ascending=False).head(5) if "deal_value" in df.columns else red.head(5)
+    top_red = red.nlargest(5, "deal_value") if "deal_value" in df.columns else red.head(5)
 
     if top_red.empty:
         elems.append(P("Нет критичных сделок", "P"))
@@ -251,9 +327,8 @@ def _digest_pdf(df: pd.DataFrame) -> bytes:
         rest = max(20*mm, doc.width - fixed)
         w_reason, w_action = rest * 0.55, rest * 0.45
 
-        header = [P("<b>ID</b>"), P("<b>Лид</b>"), P("<b>Сумма, ₽</b>"), P("<b>Последний контакт</b>"),
-                  P("<b>Уровень</b>"), P("<b>Причина</b>"), P("<b>Действие</b>"), P("<b>Kommo</b>")]
-        rows = [header]
+        # shallow-копии: без повторного парсинга, но у каждой сборки своё состояние вёрстки
+        rows = [[copy.copy(p) for p in RED_HEADER]]
 
         for _, r in top_red.iterrows():
             link = r.get("kommo") or ""
@@ -269,7 +344,7 @@ def _digest_pdf(df: pd.DataFrame) -> bytes:
                 (Paragraph(f'<a href="{link}">{link_txt}</a>', styles["P"]) if link else P("—"))
             ])
 
-        t = Table(rows, colWidths=[w_id, w_lead, w_sum, w_last, w_lvl, w_reason, w_action, w_link], repeatRows=1)
+        t = _report_table(rows, colWidths=[w_id, w_lead, w_sum, w_last, w_lvl, w_reason, w_action, w_link])
         t.setStyle(TableStyle([
             ('FONTNAME', (0,0), (-1,-1), base_font),
             ('FONTSIZE', (0,0), (-1,-1), 9),
@@ -286,7 +361,8 @@ def _digest_pdf(df: pd.DataFrame) -> bytes:
         elems.append(t)
 
     # ===== ЖЁЛТЫЕ (топ-10) =====
-    if not yellow.empty:
+    if kpis["yellow_n"]:
+        yellow = df[df["risk_level"] == "yellow"]
         elems.append(Spacer(1, 10))
         elems.append(P("Жёлтые сделки (топ-10 по сумме)", "H2"))
 
@@ -295,11 +371,9 @@ def _digest_pdf(df: pd.DataFrame) -> bytes:
         rest = max(20*mm, doc.width - fixed)
         w_reason, w_action = rest * 0.50, rest * 0.50
 
-        header = [P("<b>ID</b>"), P("<b>Лид</b>"), P("<b>Сумма, ₽</b>"), P("<b>Последний контакт</b>"),
-                  P("<b>Причина</b>"), P("<b>Действие</b>")]
-        rows = [header]
+        rows = [[copy.copy(p) for p in YELLOW_HEADER]]
 
-        yv = yellow.sort_values("deal_value", ascending=False).head(10) if "deal_value" in yellow.columns else yellow.head(10)
+        yv = yellow.nlargest(10, "deal_value") if "deal_value" in yellow.columns else yellow.head(10)
         for _, r in yv.iterrows():
             rows.append([
                 P(str(r.get("deal_id","—"))),
@@ -310,7 +384,7 @@ def _digest_pdf(df: pd.DataFrame) -> bytes:
                 Paragraph(str(r.get("action","—")), styles["Wrap"])
             ])
 
-        yt = Table(rows, colWidths=[w_id, w_lead, w_sum, w_last, w_reason, w_action], repeatRows=1)
+        yt = _report_table(rows, colWidths=[w_id, w_lead, w_sum, w_last, w_reason, w_action])
         yt.setStyle(TableStyle([
             ('FONTNAME', (0,0), (-1,-1), base_font),
             ('FONTSIZE', (0,0), (-1,-1), 9),
@@ -336,27 +410,39 @@ def _digest_pdf(df: pd.DataFrame) -> bytes:
     return pdf
 
 
-def kommo_url(base_url: str, deal_id: str) -> str:
-    return f"{base_url.rstrip('/')}/leads/detail/{deal_id}" if base_url and str(deal_id).strip() else ""
+def kommo_urls(base_url: str, deal_ids: pd.Series) -> pd.Series:
+    """Ссылки на карточки сделок; префикс считаем один раз на колонку, пустые id/база -> ''."""
+    if not base_url:
+        return pd.Series("", index=deal_ids.index)
+    prefix = base_url.rstrip("/") + "/leads/detail/"
+    ids = deal_ids.astype(str).str.strip()
+    return (prefix + ids).where(ids.ne(""), "")
 
 
-def _days_since_any(s: str | None) -> int:
-    if not s: return 9999
-    try:
-        dt = pd.to_datetime(s, utc=False, errors="coerce")
-        if pd.isna(dt): return 9999
-        return max(0, int((pd.Timestamp(datetime.now()) - dt).days))
-    except Exception:
-        return 9999
-
-def _stage_age_days(s: str | None) -> int:
-    if not s: return 0
-    try:
-        dt = pd.to_datetime(s, utc=False, errors="coerce")
-        if pd.isna(dt): return 0
-        return max(0, int((pd.Timestamp(datetime.now()) - dt).days))
-    except Exception:
-        return 0
+def _days_since_series(s: pd.Series, default: int) -> pd.Series:
+    """Дней с даты для всей колонки разом; пустые/кривые даты -> default."""
+    dt = pd.to_datetime(s, errors="coerce")
+    days = (pd.Timestamp(datetime.now()) - dt).dt.days
+    return days.clip(lower=0).fillna(default).astype("int32")
+
+
+# порядок важности: сортировка по risk_level идёт red -> yellow -> green
+RISK_LEVELS = ["red", "yellow", "green"]
+
+def _risk_kpis(df: pd.DataFrame) -> dict:
+    """KPI по уровням риска одним groupby (вместо отдельных масок под PDF и под карточки)."""
+    agg = (df.groupby("risk_level", observed=False)
+             .agg(n=("deal_id", "size"), total=("deal_value", "sum"))
+             .reindex(RISK_LEVELS, fill_value=0))
+    return {
+        "red_n": int(agg.at["red", "n"]),
+        "red_total": int(agg.at["red", "total"]),
+        "yellow_n": int(agg.at["yellow", "n"]),
+    }
+
+# признаки, которые уходят в LLM (порядок = порядок в промпте)
+FEATURE_COLUMNS = ["deal_id", "client_name", "stage", "last_contact_days",
+                   "stage_age_days", "deal_value", "last_message_text"]
 
 
 # ---------------- Main flow ----------------
@@ -376,37 +462,41 @@ if refresh_clicked:
         if df is None or df.empty:
             st.warning("Нет данных.")
         else:
-            scores, levels, reasons, actions = [], [], [], []
+            df["last_contact_days"] = _days_since_series(df["last_contact_date"], default=9999)
+            df["stage_age_days"] = _days_since_series(df["last_stage_change_date"], default=0)
+
+            df["deal_value"] = pd.to_numeric(df["deal_value"], errors="coerce").fillna(0.0)
+            df["last_message_text"] = df["last_message_text"].fillna("")
+            feat_list = (df[FEATURE_COLUMNS]
+                         .astype({"deal_id": str, "client_name": str, "stage": str, "last_message_text": str})
+                         .to_dict(orient="records"))
 
             with st.spinner("Оцениваем риски LLM..."):
-                for _, row in df.iterrows():
-                    feats = {
-                        "deal_id": str(row.get("deal_id", "")),
-                        "client_name": str(row.get("client_name", "")),
-                        "stage": str(row.get("stage", "")),
-                        "last_contact_days": _days_since_any(row.get("last_contact_date")),
-                        "stage_age_days": _stage_age_days(row.get("last_stage_change_date")),
-                        "deal_value": float(row.get("deal_value", 0) or 0),
-                        "last_message_text": str(row.get("last_message_text", "")),
-                    }
-                    res = client.assess_risk_llm(feats)
-                    scores.append(res["score"]); levels.append(res["level"])
-                    reasons.append(res["reason"]); actions.append(res["action"])
+                # сделки уходят в LLM пачками (один промпт на пачку), пачки — параллельно пулом потоков;
+                # порядок сохраняется
+                bs = SETTINGS.llm_batch_size
+                batches = [feat_list[i:i + bs] for i in range(0, len(feat_list), bs)]
+                with ThreadPoolExecutor(max_workers=SETTINGS.llm_concurrency) as ex:
+                    results = [r for batch in ex.map(client.assess_risk_llm_batch, batches) for r in batch]
+            scores, levels, reasons, actions = zip(
+                *((r["score"], r["level"], r["reason"], r["action"]) for r in results)
+            )
 
             df_out = df.copy()
-            df_out["risk_score"]  = scores
-            df_out["risk_level"]  = levels
-            df_out["risk_reason"] = reasons
-            df_out["action"]      = actions
-            df_out["kommo"]       = df_out["deal_id"].apply(lambda x: kommo_url(BASE, x))
-            df_out["last_contact_days"] = df_out["last_contact_date"].apply(_days_since_any)
+            df_out["risk_score"]  = list(scores)
+            df_out["risk_level"]  = pd.Categorical(levels, categories=RISK_LEVELS, ordered=True)
+            df_out["risk_reason"] = list(reasons)
+            df_out["action"]      = list(actions)
+            df_out["kommo"]       = kommo_urls(BASE, df_out["deal_id"])
 
+            kpis = _risk_kpis(df_out)
             st.session_state["df_out"] = df_out
+            st.session_state["kpis"] = kpis
             st.session_state.setdefault("drafts", {})
             st.session_state["data_ready"] = True
 
             try:
-                st.session_state["risk_pdf"] = _digest_pdf(df_out)
+                st.session_state["risk_pdf"] = _digest_pdf(df_out, kpis)
             except Exception as e:
                 st.session_state["risk_pdf"] = None
                 st.warning(f"Не удалось собрать PDF: {e}")
@@ -423,7 +513,7 @@ with st.sidebar:
             st.session_state["kommo_base"] = base_input.rstrip("/")
             st.session_state["kommo_token"] = token_input
             # очистим прежнее состояние
-            for k in ("df_out", "risk_pdf", "data_ready"):
+            for k in ("df_out", "kpis", "risk_pdf", "data_ready"):
                 st.session_state.pop(k, None)
             st.success("Подключено ✅ Нажмите «Посмотреть риски».")
         except Exception as e:
@@ -435,21 +525,20 @@ df_out = st.session_state.get("df_out")
 if not st.session_state.get("data_ready") or df_out is None or df_out.empty:
     st.info("Нажмите «Посмотреть риски», чтобы подтянуть сделки и оценить их LLM-ом.")
 else:
-    red = df_out[df_out["risk_level"] == "red"]
-    yellow = df_out[df_out["risk_level"] == "yellow"]
+    kpis = st.session_state.get("kpis") or _risk_kpis(df_out)
     kpi_html = f"""
     <div class="kpi-row">
       <div class="kpi-card">
         <div class="kpi-label">Красные сделки</div>
-        <div class="kpi-value">{len(red)}</div>
+        <div class="kpi-value">{kpis["red_n"]}</div>
       </div>
       <div class="kpi-card">
         <div class="kpi-label">Cумма красных сделок, ₽</div>
-        <div class="kpi-value">{int(red["deal_value"].sum()) if "deal_value" in df_out else 0}</div>
+        <div class="kpi-value">{kpis["red_total"]}</div>
       </div>
       <div class="kpi-card">
         <div class="kpi-label">Жёлтые сделки</div>
-        <div class="kpi-value">{len(yellow)}</div>
+        <div class="kpi-value">{kpis["yellow_n"]}</div>
       </div>
     </div>
     """
@@ -462,54 +551,36 @@ else:
     with c2:
         top_by_value = st.checkbox("Топ-10 по сумме", value=False, key="flt_top_value")
 
-    order = {"red": 0, "yellow": 1, "green": 2}
-    view = (df_out.copy()
-            .assign(_ord=df_out["risk_level"].map(order))
-            .sort_values(["_ord", "risk_score"], ascending=[True, False]))
+    view = df_out.sort_values(["risk_level", "risk_score"], ascending=[True, False])
 
     if only_red:
         view = view[view["risk_level"] == "red"]
     if top_by_value and "deal_value" in view.columns:
-        view = view.sort_values("deal_value", ascending=False).head(10)
+        view = view.nlargest(10, "deal_value")
 
     st.subheader("Приоритеты")
 
+    # карточки рендерим одним markdown-блоком постранично, действия — для одной выбранной сделки:
+    # иначе на каждую сделку создаются свои виджеты и rerun тормозит на сотнях лидов
+    n_pages = max(1, math.ceil(len(view) / PAGE_SIZE))
+    page = st.selectbox("Страница", range(1, n_pages + 1), key="page") if n_pages > 1 else 1
+    page_view = view.iloc[(page - 1) * PAGE_SIZE: page * PAGE_SIZE]
 
-    for _, r in view.iterrows():
-        level = r["risk_level"]
-        badge = f'<span class="badge {level}">{level.upper()}</span>'
-
-        lc = r.get("last_contact_date") or "—"
-        lcd = int(r.get("last_contact_days") or 0)
-        sla_txt = "OK" if lcd <= SLA_DAYS else "SLA: просрочен"
-        reason = r.get("risk_reason") or "—"
-        action = r.get("action") or "—"
-        kommo_link = r.get("kommo") or "#"
-        name = r.get("client_name") or f"Lead #{r.get('deal_id', '')}"
-
-        card_html = f"""
-        <div class="lead-card">
-          <div class="lead-head">
-            <div>
-              <div class="lead-name">{name}</div>
-              <div class="lead-sec">Последний контакт: {lc} • {sla_txt}</div>
-            </div>
-            {badge}
-          </div>
-          <div class="lead-body">
-            <b>Причина:</b> {reason}<br/>
-            <b>Действие:</b> {action}
-          </div>
-          <div class="lead-actions">
-            <a class="link-btn" href="{kommo_link}" target="_blank">Открыть в Kommo</a>
-          </div>
-        </div>
-        """
-        st.markdown(card_html, unsafe_allow_html=True)
+    cards = page_view.assign(
+        badge_html=page_view["risk_level"].astype(str).map(BADGE_HTML).fillna(""),
+        sla_txt=(page_view["last_contact_days"].fillna(0) <= SLA_DAYS).map({True: "OK", False: "SLA: просрочен"}),
+    )
+    st.markdown("".join(_card_html(r) for r in cards.itertuples(index=False)), unsafe_allow_html=True)
+
+    if not page_view.empty:
+        st.subheader("Действия по сделке")
+        names = dict(zip(page_view["deal_id"], page_view["client_name"]))
+        deal_key = st.selectbox("Выбрать сделку", list(names), format_func=lambda d: f"{names[d]} (#{d})", key="sel_deal")
+        r = page_view[page_view["deal_id"] == deal_key].iloc[0]
 
         colA, colB = st.columns(2)
         with colA:
-            if st.button("Создать задачу в Kommo", key=f"task_{r['deal_id']}"):
+            if st.button("Создать задачу в Kommo", key="task_btn"):
                 try:
                     BASE, TOKEN = get_kommo_creds()
                     create_task(
@@ -525,13 +596,13 @@ else:
 
         with colB:
             with st.expander("Сгенерировать письмо"):
-                deal_key = str(r["deal_id"])
                 existing = st.session_state.setdefault("drafts", {}).get(deal_key, "")
                 st.text_area("Письмо", value=existing, height=150, key=f"txt_{deal_key}")
                 if st.button("Сгенерировать", key=f"draft_{deal_key}"):
                     try:
                         with st.spinner("Генерируем письмо..."):
-                            draft = client.draft_followup(r["client_name"], reason, r.get("last_message_text", ""))
+                            draft = client.draft_followup(r["client_name"], r.get("risk_reason") or "—",
+                                                          r.get("last_message_text", ""))
                         st.session_state["drafts"][deal_key] = draft
                         try:
                             st.rerun()
@@ -544,7 +615,7 @@ else:
     st.markdown("---")
     pdf_bytes = st.session_state.get("risk_pdf")
     if pdf_bytes:
-        st.markdown(get_pdf_download_link(pdf_bytes, "risk_report.pdf", "Скачать отчёт (PDF)"),
-                    unsafe_allow_html=True)
+        st.download_button("Скачать отчёт (PDF)", data=pdf_bytes, file_name="risk_report.pdf",
+                           mime="application/pdf", key="pdf_download")
     else:
         st.info("Отчёт (PDF) недоступен — обнови данные и попробуй снова.")
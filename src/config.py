@@ -11,6 +11,12 @@ class Settings(BaseModel):
     timezone: str = os.getenv("TIMEZONE", "Europe/Moscow")
     request_timeout_seconds: int = int(os.getenv("REQUEST_TIMEOUT_SECONDS", "20"))
     request_max_retries: int = int(os.getenv("REQUEST_MAX_RETRIES", "2"))
+    llm_concurrency: int = int(os.getenv("LLM_CONCURRENCY", "12"))
+    llm_batch_size: int = int(os.getenv("LLM_BATCH_SIZE", "16"))
+    llm_stream: bool = os.getenv("LLM_STREAM", "0").lower() in ("1", "true", "yes")  # потоковый ответ для JSON-запросов
+    llm_rpm: int = int(os.getenv("LLM_RPM", "0"))  # лимит запросов/мин к LLM; 0 = без ограничения
+    llm_cache_ttl_seconds: int = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+    llm_cache_path: str = os.getenv("LLM_CACHE_PATH", ".llm_cache.sqlite3")  # пусто = только in-memory
 
 SETTINGS = Settings()
 
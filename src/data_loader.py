@@ -1,69 +1,106 @@
 from __future__ import annotations
-import os, time, requests
+import os, math, requests
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, Any, List, Optional, Callable
 from dotenv import load_dotenv, find_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .rate_limiter import RateLimiter
+from . import json_compat as json
 
 
-load_dotenv(find_dotenv(), override=True)
-
-BASE = os.getenv("KOMMO_BASE_URL", "").rstrip("/")
-TOKEN = os.getenv("KOMMO_ACCESS_TOKEN", "")
 LIMIT = int(os.getenv("KOMMO_API_LIMIT", "100"))
+NOTES_CONCURRENCY = int(os.getenv("KOMMO_NOTES_CONCURRENCY", "16"))
+# Kommo пускает не больше 7 запросов/сек на интеграцию — сверх этого отвечает 429
+MAX_RPS = float(os.getenv("KOMMO_MAX_RPS", "7"))
+_LIMITER = RateLimiter(MAX_RPS)
+
+# Сессия на токен: заголовки (включая Authorization) задаются один раз, соединения к хосту
+# переиспользуются между страницами и заметками. Ретраи с backoff — только для идемпотентных GET
+# (POST задачи не должен задублироваться).
+@lru_cache(maxsize=8)
+def _session_for(token: str) -> requests.Session:
+    s = requests.Session()
+    s.headers.update({
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+        "User-Agent": "kommo-client/1.0",
+    })
+    s.mount("https://", HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False,  # отдаём последний ответ, ошибку поднимет raise_for_status
+        ),
+    ))
+    return s
+
+def _resolve_creds(base_url: Optional[str], token: Optional[str]) -> tuple[str, str]:
+    """Явные креды приоритетнее; .env читаем только если чего-то не передали."""
+    if not base_url or not token:
+        load_dotenv(find_dotenv())
+        base_url = base_url or os.getenv("KOMMO_BASE_URL", "")
+        token = token or os.getenv("KOMMO_ACCESS_TOKEN", "")
+    return (base_url or "").rstrip("/"), token or ""
+
+def _get(url: str, token: str, params: Optional[Dict[str, Any]] = None, timeout: int = 20) -> Dict[str, Any]:
+    if not token:
+        raise RuntimeError("Kommo access token is not set (pass it explicitly or set KOMMO_ACCESS_TOKEN in .env)")
+    _LIMITER.wait()
+    r = _session_for(token).get(url, params=params, timeout=timeout)
+    # 204 = пустой ответ -> вернём пустую структуру
+    if r.status_code == 204 or not (r.text or "").strip():
+        return {}
+    r.raise_for_status()
+    ct = (r.headers.get("Content-Type") or "").lower()
+    if "json" in ct:
+        return json.loads(r.content)
+    raise RuntimeError(
+        f"Unexpected response (status {r.status_code}, CT={ct}): {r.text[:300]}"
+    )
 
-def _headers(token: str) -> dict:
-    return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-def _get(url: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    if not BASE or not TOKEN:
-        raise RuntimeError("Set KOMMO_BASE_URL and KOMMO_ACCESS_TOKEN in .env")
-    for attempt in range(3):
-        try:
-            r = requests.get(
-                url,
-                headers={
-                    "Authorization": f"Bearer {TOKEN}",
-                    "Accept": "application/json",
-                    "Content-Type": "application/json",
-                    "User-Agent": "kommo-client/1.0",
-                },
-                params=params,
-                timeout=20,
-            )
-            # 204 = пустой ответ -> вернём пустую структуру
-            if r.status_code == 204 or not (r.text or "").strip():
-                return {}
-            r.raise_for_status()
-            ct = (r.headers.get("Content-Type") or "").lower()
-            if "json" in ct:
-                return r.json()
-            raise RuntimeError(
-                f"Unexpected response (status {r.status_code}, CT={ct}): {r.text[:300]}"
-            )
-        except Exception:
-            if attempt == 2:
-                raise
-            time.sleep(1 + attempt)
+
+def _fetch_leads_page(base_url: str, token: str, page: int, per_page: int) -> List[Dict[str, Any]]:
+    url = f"{base_url.rstrip('/')}/api/v4/leads"
+    # за последней страницей Kommo отвечает 204 -> _get вернёт {}
+    data = _get(url, token, params={"page": page, "limit": per_page})
+    return (data.get("_embedded") or {}).get("leads") or []
 
 
 def fetch_leads(base_url: str, token: str, limit: int = 200):
-    url = f"{base_url.rstrip('/')}/api/v4/leads?limit={limit}"
-    r = requests.get(url, headers=_headers(token), timeout=20)
-    r.raise_for_status()
-    return r.json()
+    """
+    Загружает до limit сделок страницами по KOMMO_API_LIMIT.
+    Первая страница идёт одна (узнаём, есть ли продолжение), остальные — параллельно.
+    Возвращает ответ в формате Kommo: {"_embedded": {"leads": [...]}}.
+    """
+    per_page = max(1, min(limit, LIMIT))
+    leads = _fetch_leads_page(base_url, token, 1, per_page)
+
+    pages = math.ceil(limit / per_page)
+    if len(leads) == per_page and pages > 1:
+        with ThreadPoolExecutor(max_workers=min(pages - 1, 8)) as ex:
+            for chunk in ex.map(lambda p: _fetch_leads_page(base_url, token, p, per_page), range(2, pages + 1)):
+                leads.extend(chunk)
+
+    return {"_embedded": {"leads": leads[:limit]}}
 
 def fetch_last_note(lead_id: int, *, base_url: str, token: str, timeout: int = 10) -> str:
     """
     Возвращает текст последней заметки/сообщения по сделке.
     Работает в контексте конкретного аккаунта (base_url + token).
     """
-    url = f"{base_url}/api/v4/leads/{lead_id}/notes"
+    url = f"{base_url.rstrip('/')}/api/v4/leads/{lead_id}/notes"
     params = {"limit": 1, "page": 1, "order": "desc"}  # последняя
-    headers = {"Authorization": f"Bearer {token}"}
 
-    r = requests.get(url, headers=headers, params=params, timeout=timeout)
-    r.raise_for_status()
-    notes = r.json().get("_embedded", {}).get("notes", [])
+    data = _get(url, token, params=params, timeout=timeout)
+    notes = (data.get("_embedded") or {}).get("notes", [])
     if not notes:
         return ""
 
@@ -78,6 +115,23 @@ def fetch_last_note(lead_id: int, *, base_url: str, token: str, timeout: int = 1
     return (text or "").strip()
 
 
+# поля сделки Kommo, из которых строится фрейм для риск-движка
+LEAD_FIELDS = ["id", "name", "price", "status_id", "updated_at", "created_at", "responsible_user_id"]
+
+
+def _id_column(s: pd.Series) -> pd.Series:
+    """ID Kommo -> строки без хвоста '.0' от NaN-апкаста; пропуски -> ''."""
+    return pd.to_numeric(s, errors="coerce").astype("Int64").astype(str).replace("<NA>", "")
+
+
+def _note_id(lead: Dict[str, Any]) -> Optional[int]:
+    """ID сделки для запроса заметок; пустой/нечисловой -> None."""
+    try:
+        return int(lead["id"]) if lead.get("id") else None
+    except (TypeError, ValueError):
+        return None
+
+
 def normalize_to_df(
     leads: List[Dict[str, Any]],
     fetch_notes: bool = True,
@@ -89,56 +143,62 @@ def normalize_to_df(
     Приводим к формату риск-движка. ВАЖНО: заметки тянем теми же base_url/token,
     что и сами лиды. Либо передайте готовый note_fetcher, уже "забинденный" на креды.
     """
-    base_url = (base_url or os.getenv("KOMMO_BASE_URL", "")).rstrip("/")
-    token = token or os.getenv("KOMMO_ACCESS_TOKEN", "")
+    if fetch_notes and note_fetcher is None:
+        base_url, token = _resolve_creds(base_url, token)
 
     if fetch_notes and note_fetcher is None and (not base_url or not token):
         fetch_notes = False  # безопасный даунгрейд
 
-    rows: List[Dict[str, Any]] = []
-    for lead in leads:
-        lead_id = lead.get("id")
-        name = lead.get("name") or f"Lead {lead_id}"
-        price = lead.get("price") or 0
-        status_id = lead.get("status_id")
-        ts = lead.get("updated_at") or lead.get("created_at")
-
-        last_date = ""
-        if ts:
-            import datetime
-            last_date = datetime.datetime.utcfromtimestamp(int(ts)).date().isoformat()
-
-        # берём заметку строго из ТЕКУЩЕГО аккаунта
-        last_msg = ""
-        if fetch_notes and lead_id:
+    # заметки — по одному HTTP-запросу на сделку, поэтому тянем их пулом потоков
+    notes: Dict[int, str] = {}
+    if fetch_notes:
+        fetch = note_fetcher or (lambda lid: fetch_last_note(lid, base_url=base_url, token=token))
+
+        def _safe_fetch(lid: int) -> str:
             try:
-                if note_fetcher is not None:
-                    last_msg = note_fetcher(int(lead_id)) or ""
-                else:
-                    last_msg = fetch_last_note(int(lead_id), base_url=base_url, token=token) or ""
+                return fetch(lid) or ""
             except Exception:
                 # не даём упасть пайплайну из-за одной кривой заметки
-                last_msg = ""
-
-        rows.append({
-            "deal_id": str(lead_id),
-            "client_name": name,
-            "stage": str(status_id),              # ID стадии
-            "last_contact_date": last_date,       # yyyy-mm-dd
-            "last_message_text": last_msg,
-            "owner": str(lead.get("responsible_user_id")),
-            "deal_value": float(price or 0),
-            "last_stage_change_date": None,       # можно доработать позже
-        })
-
-    return pd.DataFrame(rows)
+                return ""
+
+        # одна сделка может попасть в выборку дважды (сдвиг страниц между запросами) —
+        # заметку по ней тянем один раз, результат всё равно раскладывается по id
+        # нечисловой id не должен ронять весь фрейм: такая сделка просто останется без заметки
+        ids = list(dict.fromkeys(lid for lid in map(_note_id, leads) if lid is not None))
+        with ThreadPoolExecutor(max_workers=NOTES_CONCURRENCY) as ex:
+            notes = dict(zip(ids, ex.map(_safe_fetch, ids)))
+
+    # колонками (dict-of-lists), а не списком словарей: pandas не разбирает каждую запись по ключам
+    raw = pd.DataFrame({field: [lead.get(field) for lead in leads] for field in LEAD_FIELDS})
+    deal_id = _id_column(raw["id"])
+    name = raw["name"].fillna("").astype(str)
+    # unix-время Kommo (UTC) -> yyyy-mm-dd одним векторным преобразованием; 0/пусто = нет даты,
+    # как было с `updated_at or created_at`
+    updated = pd.to_numeric(raw["updated_at"], errors="coerce")
+    created = pd.to_numeric(raw["created_at"], errors="coerce")
+    ts = updated.where(updated > 0, created)
+    last_contact_date = (pd.to_datetime(ts.where(ts > 0), unit="s", utc=True, errors="coerce")
+                         .dt.strftime("%Y-%m-%d").fillna(""))
+
+    return pd.DataFrame({
+        "deal_id": deal_id,
+        "client_name": name.where(name.ne(""), "Lead " + deal_id),
+        "stage": _id_column(raw["status_id"]),    # ID стадии
+        "last_contact_date": last_contact_date,
+        # заметка взята строго из ТЕКУЩЕГО аккаунта (см. выше)
+        "last_message_text": pd.to_numeric(raw["id"], errors="coerce").map(notes).fillna(""),
+        "owner": _id_column(raw["responsible_user_id"]),
+        "deal_value": pd.to_numeric(raw["price"], errors="coerce").fillna(0.0).astype(float),
+        "last_stage_change_date": None,           # можно доработать позже
+    })
 
 
 def create_task(base_url: str, token: str, lead_id: int, text: str, complete_till: int, responsible_user_id: int | None = None):
     url = f"{base_url.rstrip('/')}/api/v4/tasks"
     payload = [{"text": text, "complete_till": complete_till, "entity_id": lead_id, "entity_type": "leads",
                 **({"responsible_user_id": responsible_user_id} if responsible_user_id else {})}]
-    r = requests.post(url, headers=_headers(token), json=payload, timeout=20)
+    _LIMITER.wait()
+    r = _session_for(token).post(url, data=json.dumps(payload).encode("utf-8"), timeout=20)
     r.raise_for_status()
-    return r.json()
+    return json.loads(r.content)
 
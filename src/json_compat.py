@@ -0,0 +1,21 @@
+from __future__ import annotations
+import json
+from typing import Any, Union
+
+# orjson (нативный код) заметно быстрее stdlib json на промптах, ответах LLM и страницах Kommo;
+# если пакет не установлен — тихо работаем на stdlib с тем же поведением
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def loads(s: Union[str, bytes]) -> Any:
+    return orjson.loads(s) if orjson else json.loads(s)
+
+
+def dumps(obj: Any) -> str:
+    """JSON-строка без \\u-экранирования кириллицы (как json.dumps(ensure_ascii=False))."""
+    if orjson:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
@@ -1,8 +1,16 @@
 from __future__ import annotations
-import time, json, re, hashlib
+import time, re, hashlib, sqlite3, threading
 import requests
-from typing import Dict, Any
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Any, List, Optional
+try:
+    import xxhash
+except ImportError:  # pragma: no cover
+    xxhash = None
 from .config import SETTINGS
+from . import json_compat as json
+from .rate_limiter import RateLimiter
 
 POSTPONE_PATTERNS = [
     r"\bчерез\s+недел", r"\bна\s+следующ(ей|ую)\s+недел",
@@ -14,26 +22,162 @@ CHOOSE_OTHER_PATTERNS = [r"\bвыбрали\s+другого\b", r"\bостан
 REFUSAL_PATTERNS = [r"\bоткаж\w*\b", r"\bнеинтересно\b"]
 
 
+TRIGGER_PATTERNS = {
+    "postpone": POSTPONE_PATTERNS,
+    "price_objection": PRICE_PATTERNS,
+    "chose_other": CHOOSE_OTHER_PATTERNS,
+    "refusal": REFUSAL_PATTERNS,
+}
+# по одному предкомпилированному регэкспу на категорию: общая альтернатива с finditer теряла
+# перекрывающиеся совпадения («остановились на следующей неделе» — и chose_other, и postpone)
+_TRIGGER_RES = {name: re.compile("|".join(pats), re.I) for name, pats in TRIGGER_PATTERNS.items()}
+
+
 def semantic_triggers(text: str) -> list[str]:
     t = (text or "").lower()
+    return [name for name, rx in _TRIGGER_RES.items() if rx.search(t)]
+
+
+# общий пул keep-alive соединений к LLM-эндпоинту на все потоки/сессии Streamlit;
+# ретраи 429/5xx/обрывов с экспоненциальным backoff делает urllib3
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        # REQUEST_MAX_RETRIES — общее число попыток (как было в ручном цикле), Retry.total — число повторов
+        total=max(SETTINGS.request_max_retries - 1, 0),
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        raise_on_status=False,
+    ),
+)
+# LLM_API_URL настраивается и часто смотрит на локальный LiteLLM-прокси по http — монтируем на обе схемы
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+# общий на все потоки лимит частоты: параллельные вызовы не должны выбивать квоту провайдера (429)
+_LIMITER = RateLimiter(SETTINGS.llm_rpm / 60)
+
+class _SqliteCache:
+    """
+    Персистентный KV-кэш ответов LLM: переживает рестарт приложения.
+    Одно соединение на процесс, доступ из пула потоков сериализуется lock-ом.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            # протухшие записи чистим при старте, чтобы файл не рос бесконечно
+            self._conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, key: str) -> Optional[tuple[float, dict]]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if not row or row[1] <= time.time():
+            return None
+        return row[1], json.loads(row[0])
+
+    def set(self, key: str, value: dict, expires_at: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+
+
+def _open_disk_cache(path: str) -> Optional[_SqliteCache]:
+    if not path:
+        return None
+    try:
+        return _SqliteCache(path)
+    except sqlite3.Error:
+        # read-only FS и т.п. — работаем на одном in-memory кэше
+        return None
+
+
+# key -> (expires_at, result); L1 в памяти перед SQLite
+_CACHE: dict[str, tuple[float, dict]] = {}
+# к кэшу одновременно ходят потоки пула оценки рисков
+_CACHE_LOCK = threading.Lock()
+_DISK_CACHE = _open_disk_cache(SETTINGS.llm_cache_path)
+
+
+def _cache_get(key: str) -> Optional[dict]:
+    with _CACHE_LOCK:
+        hit = _CACHE.get(key)
+    if hit is None and _DISK_CACHE is not None:
+        try:
+            hit = _DISK_CACHE.get(key)
+        except (sqlite3.Error, ValueError):
+            # locked/удалённый файл, битая запись — считаем промахом, работаем на in-memory
+            hit = None
+        if hit is not None:
+            with _CACHE_LOCK:
+                _CACHE[key] = hit
+    if hit and hit[0] > time.time():
+        return hit[1]
+    return None
+
+
+def _cache_put(key: str, value: dict, persist: bool = True) -> None:
+    expires_at = time.time() + SETTINGS.llm_cache_ttl_seconds
+    with _CACHE_LOCK:
+        _CACHE[key] = (expires_at, value)
+    if persist and _DISK_CACHE is not None:
+        try:
+            _DISK_CACHE.set(key, value, expires_at)
+        except sqlite3.Error:
+            # "database is locked" при нескольких процессах, полный диск — результат уже есть в L1
+            pass
+
+
+MAX_MESSAGE_CHARS = 512
+
+
+def _normalize_features(features: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Канонизируем признаки: несущественные отличия (копейки, пробелы, хвост длинной заметки)
+    не должны порождать новый запрос к LLM.
+    """
+    feats = dict(features)
+    feats["deal_value"] = round(float(feats.get("deal_value") or 0), 2)
+    feats["last_message_text"] = str(feats.get("last_message_text") or "").strip()[:MAX_MESSAGE_CHARS]
+    return feats
+
 
-    def any_match(pats):
-        return any(re.search(p, t, re.I) for p in pats)
+_NON_WORD_RE = re.compile(r"[^\w]+")
 
-    triggers = []
-    if any_match(POSTPONE_PATTERNS): triggers.append("postpone")
-    if any_match(PRICE_PATTERNS): triggers.append("price_objection")
-    if any_match(CHOOSE_OTHER_PATTERNS): triggers.append("chose_other")
-    if any_match(REFUSAL_PATTERNS): triggers.append("refusal")
-    return triggers
 
+def _canonical_text(text: str) -> str:
+    """Текст только для ключа кэша: регистр, ё/е, пунктуация и пробелы на смысл не влияют."""
+    return _NON_WORD_RE.sub(" ", text.lower().replace("ё", "е")).strip()
 
-_CACHE: dict[str, dict] = {}
+
+def _cache_key(guarded_feats: Dict[str, Any]) -> str:
+    """
+    Ключ кэша по признакам. Сообщение сравниваем в канонической форме, поэтому «Давайте позже!»
+    и «давайте  позже» попадают в одну запись; триггеры входят в ключ, так что смысловой сдвиг
+    (появился отказ/перенос) кэш не перепутает.
+    """
+    feats = dict(guarded_feats)
+    feats["last_message_text"] = _canonical_text(str(feats.get("last_message_text") or ""))
+    return _hash_features(feats)
 
 
 def _hash_features(feats: Dict[str, Any]) -> str:
-    s = json.dumps(feats, ensure_ascii=False, sort_keys=True)
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+    # repr отсортированного кортежа вместо json.dumps; hash() не годится — он солится на каждый процесс,
+    # а ключ живёт и в дисковом кэше. Хэш некриптографический: ключ кэша, а не подпись
+    canon = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in feats.items()))
+    data = repr(canon).encode("utf-8")
+    if xxhash is not None:
+        return xxhash.xxh3_64_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 
 def _extract_json_block(text: str) -> dict:
@@ -46,6 +190,140 @@ def _extract_json_block(text: str) -> dict:
     return json.loads(m.group(0))
 
 
+def _extract_json_array(text: str) -> List[dict]:
+    """Первый JSON-массив объектов из ответа модели (для пакетной оценки)."""
+    # массив объектов: "[" сразу за которой "{" или "]" — прозаическое «[см. ниже]» перед ним пропускаем
+    m = re.search(r"\[\s*[{\]].*\]", text, re.S)
+    if not m:
+        raise ValueError("No JSON array found in LLM response")
+    arr = json.loads(m.group(0))
+    if not isinstance(arr, list) or not all(isinstance(x, dict) for x in arr):
+        raise ValueError("LLM response is not a JSON array of objects")
+    return arr
+
+
+RISK_RULES = """Ты ассистент руководителя продаж. Оцени РИСК по сделке и предложи КОРОТКОЕ действие менеджеру.
+ОПИРАЙСЯ ТОЛЬКО на переданные признаки. НЕ придумывай факторы.
+
+Уровень риска определяется по строгим ПРИОРИТЕТНЫМ правилам:
+1.  **КРАСНЫЙ (RED) - ВЫСОКИЙ РИСК:**
+    - last_contact_days > 21.
+    - Один из триггеров: "refusal", "chose_other", "price_objection" (очень негативный).
+    - Причина - отказ или выбор другого поставщика.
+2.  **ЖЕЛТЫЙ (YELLOW) - СРЕДНИЙ РИСК:**
+    - last_contact_days от 7 до 21.
+    - Триггер "postpone" (перенос) или другие слова, указывающие на задержку.
+    - Возраст сделки (stage_age_days) > 14 дней.
+    - Последнее сообщение клиента содержит негативную тональность.
+3.  **ЗЕЛЕНЫЙ (GREEN) - НИЗКИЙ РИСК:**
+    - last_contact_days < 7.
+    - Нет негативных или отказных триггеров.
+    - Нет проблем с возрастом сделки.
+"""
+
+FALLBACK_ASSESSMENT = {"score": 1.0, "level": "yellow", "reason": "fallback: не удалось распарсить ответ",
+                       "action": "Связаться с клиентом"}
+
+
+def _prepare_features(features: Dict[str, Any]) -> tuple[Dict[str, Any], list[str]]:
+    """Признаки для промпта/ключа кэша + семантические триггеры."""
+    # триггеры ищем по полному тексту, в промпт и ключ кэша идёт нормализованный
+    sem_triggers = semantic_triggers(features.get("last_message_text", ""))
+
+    # _normalize_features уже вернул свежую копию — дополняем её, без второго dict(...)
+    guarded_feats = _normalize_features(features)
+    guarded_feats["semantic_triggers"] = sem_triggers
+    return guarded_feats, sem_triggers
+
+
+RED_TRIGGERS = {"refusal", "chose_other"}
+
+
+def _rule_based_assessment(features: Dict[str, Any], sem_triggers: list[str]) -> Optional[dict]:
+    """
+    Очевидные случаи решаем без LLM (по тем же правилам, что в RISK_RULES):
+    - нет триггеров, контакт свежий, сделка не застряла -> green;
+    - отказ/выбор конкурента и давно нет контакта -> red.
+    None — решать модели.
+    """
+    lcd = int(features.get("last_contact_days", 0) or 0)
+    sad = int(features.get("stage_age_days", 0) or 0)
+    if not sem_triggers and lcd < 7 and sad <= 7:
+        return {"score": 0.3, "level": "green", "reason": "активность в норме", "action": "Поддерживать контакт"}
+    if RED_TRIGGERS.intersection(sem_triggers) and lcd > 14:
+        return {"score": 1.8, "level": "red", "reason": "клиент отказался или выбрал другого поставщика, контакта нет больше двух недель",
+                "action": "Выяснить причины отказа и предложить альтернативу"}
+    return None
+
+
+def _finalize_assessment(obj: Dict[str, Any], sem_triggers: list[str]) -> dict:
+    """Валидация ответа модели + доменные поправки. Бросает исключение на мусорном ответе."""
+    level = str(obj.get("level", "yellow")).lower()
+    if level not in {"green", "yellow", "red"}:
+        level = "yellow"
+    score = float(obj.get("score", 1.0))
+    if score < 0: score = 0.0
+    if score > 2: score = 2.0
+    reason = str(obj.get("reason", "")).strip() or "причина не указана"
+    action = str(obj.get("action", "")).strip() or "Связаться с клиентом сегодня"
+    # если клиент перенёс ("postpone"), green недопустим
+    if "postpone" in sem_triggers and level == "green":
+        level = "yellow"
+        # можно слегка подвинуть score если он слишком низкий
+        if score < 0.9: score = 0.9
+        if "перенос" not in reason and "позже" not in reason:
+            reason = (reason + "; перенос обсуждения").strip("; ").strip()
+        if not action or action.lower().startswith("свяж"):
+            action = "Запланируйте слот на следующей неделе и закрепите повестку письмом."
+    return {"score": round(score, 2), "level": level, "reason": reason, "action": action}
+
+
+class _JsonCloseDetector:
+    """
+    Инкрементально отслеживает верхнеуровневый JSON в потоке токенов. Всё до ожидаемой открывающей
+    скобки (opener: "{" или "[") — текст модели, он игнорируется; дальше учитываются вложенность,
+    строки и экранирование. feed() вернёт True, как только закрылась парная скобка верхнего уровня.
+    """
+    _PAIRS = {"{": "}", "[": "]"}
+
+    def __init__(self, opener: str):
+        self.opener = opener
+        self.stack: list[str] = []
+        self.in_str = False
+        self.esc = False
+        self.expect_item = False  # после "[" верхнего уровня ждём объект или "]", иначе это не JSON
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if not self.stack:
+                if ch == self.opener:
+                    self.stack.append(ch)
+                    self.expect_item = ch == "["
+                continue
+            if self.expect_item and not ch.isspace():
+                self.expect_item = False
+                if ch not in "{]":
+                    # прозаическое «[см. ниже]» — сбрасываемся и ищем настоящее начало
+                    self.stack.clear()
+                    continue
+            if self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif ch == "\\":
+                    self.esc = True
+                elif ch == '"':
+                    self.in_str = False
+            elif ch == '"':
+                self.in_str = True
+            elif ch in self._PAIRS:
+                self.stack.append(ch)
+            elif ch in "}]" and ch == self._PAIRS[self.stack[-1]]:
+                self.stack.pop()
+                if not self.stack:
+                    return True
+        return False
+
+
 class LLMClient:
     def __init__(self,
                  api_url: str = SETTINGS.llm_api_url,
@@ -55,26 +333,43 @@ class LLMClient:
         self.api_key = api_key
         self.model = model
         self.timeout = SETTINGS.request_timeout_seconds
-        self.max_retries = SETTINGS.request_max_retries
+        self.stream = SETTINGS.llm_stream
 
-    def _post(self, payload: dict) -> dict:
+    def _post(self, payload: dict, json_opener: Optional[str] = None) -> dict:
         headers = {
             "accept": "application/json",
             "x-litellm-api-key": self.api_key,
             "Content-Type": "application/json"
         }
-        last_err = None
-        for attempt in range(1, self.max_retries + 1):
-            try:
-                r = requests.post(self.api_url, headers=headers, json=payload, timeout=self.timeout)
-                r.raise_for_status()
-                return r.json()
-            except Exception as e:
-                last_err = e
-                if attempt == self.max_retries:
-                    raise
-                time.sleep(min(2 ** attempt, 4))
-        raise last_err
+        _LIMITER.wait()
+        if payload.get("stream"):
+            return self._post_stream(payload, headers, json_opener)
+        r = _SESSION.post(self.api_url, headers=headers, data=json.dumps(payload).encode("utf-8"), timeout=self.timeout)
+        r.raise_for_status()
+        return json.loads(r.content)
+
+    def _post_stream(self, payload: dict, headers: dict, json_opener: Optional[str] = None) -> dict:
+        """
+        Потоковый запрос (SSE): копим delta.content. Если ждём JSON (json_opener "{" или "["), обрываем
+        генерацию, как только он закрылся — хвост модели не ждём. Возвращает ответ в форме обычного completion.
+        """
+        parts = []
+        detector = _JsonCloseDetector(json_opener) if json_opener else None
+        with _SESSION.post(self.api_url, headers=headers, data=json.dumps(payload).encode("utf-8"), timeout=self.timeout, stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = ((choices[0].get("delta") or {}).get("content") or "") if choices else ""
+                parts.append(delta)
+                if detector is not None and detector.feed(delta):
+                    break  # выход из with закрывает соединение и обрывает генерацию
+        return {"choices": [{"message": {"role": "assistant", "content": "".join(parts)}}]}
 
     def classify_tone(self, text: str) -> str:
         """
@@ -95,7 +390,7 @@ positive | neutral | negative
 
     def assess_risk_llm(self, features: Dict[str, Any]) -> dict:
         """
-        LLM-only оценка риска.
+        LLM-оценка риска (однозначные случаи решаются правилами без запроса, см. _rule_based_assessment).
         Вход features:
           {
             "deal_id": str,
@@ -114,37 +409,18 @@ positive | neutral | negative
             "action": str (ru)
           }
         """
-        lcd = int(features.get("last_contact_days", 0) or 0)
-        sad = int(features.get("stage_age_days", 0) or 0)
-
-        sem_triggers = semantic_triggers(features.get("last_message_text", ""))
-
-        guarded_feats = dict(features)
-        guarded_feats["semantic_triggers"] = sem_triggers
+        guarded_feats, sem_triggers = _prepare_features(features)
+        ruled = _rule_based_assessment(features, sem_triggers)
+        if ruled is not None:
+            return ruled
 
-        key = _hash_features(guarded_feats)
-        if key in _CACHE:
-            return _CACHE[key]
+        key = _cache_key(guarded_feats)
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
 
         prompt = f"""
-Ты ассистент руководителя продаж. Оцени РИСК по сделке и предложи КОРОТКОЕ действие менеджеру.
-ОПИРАЙСЯ ТОЛЬКО на переданные признаки. НЕ придумывай факторы.
-
-Уровень риска определяется по строгим ПРИОРИТЕТНЫМ правилам:
-1.  **КРАСНЫЙ (RED) - ВЫСОКИЙ РИСК:**
-    - last_contact_days > 21.
-    - Один из триггеров: "refusal", "chose_other", "price_objection" (очень негативный).
-    - Причина - отказ или выбор другого поставщика.
-2.  **ЖЕЛТЫЙ (YELLOW) - СРЕДНИЙ РИСК:**
-    - last_contact_days от 7 до 21.
-    - Триггер "postpone" (перенос) или другие слова, указывающие на задержку.
-    - Возраст сделки (stage_age_days) > 14 дней.
-    - Последнее сообщение клиента содержит негативную тональность.
-3.  **ЗЕЛЕНЫЙ (GREEN) - НИЗКИЙ РИСК:**
-    - last_contact_days < 7.
-    - Нет негативных или отказных триггеров.
-    - Нет проблем с возрастом сделки.
-
+{RISK_RULES}
 Верни СТРОГО JSON без лишнего текста. Объяснение и действие должны быть на русском языке.
 
 {{
@@ -162,40 +438,98 @@ positive | neutral | negative
 Выход: {{"level": "red", "reason": "Клиент сообщил о высокой цене и выбрал конкурента.", "action": "Выяснить причины отказа и попытаться переубедить."}}
 
 Оцени следующие признаки:
-{json.dumps(guarded_feats, ensure_ascii=False)}
+{json.dumps(guarded_feats)}
 """
-        payload = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
-        data = self._post(payload)
+        payload = {"model": self.model, "messages": [{"role": "user", "content": prompt}], "stream": self.stream}
+        data = self._post(payload, json_opener="{")
         raw = data["choices"][0]["message"]["content"]
 
         try:
-            obj = _extract_json_block(raw)
-            level = str(obj.get("level", "yellow")).lower()
-            if level not in {"green", "yellow", "red"}:
-                level = "yellow"
-            score = float(obj.get("score", 1.0))
-            if score < 0: score = 0.0
-            if score > 2: score = 2.0
-            reason = str(obj.get("reason", "")).strip() or "причина не указана"
-            action = str(obj.get("action", "")).strip() or "Связаться с клиентом сегодня"
-            # если клиент перенёс ("postpone"), green недопустим
-            if "postpone" in sem_triggers and level == "green":
-                level = "yellow"
-                # можно слегка подвинуть score если он слишком низкий
-                if score < 0.9: score = 0.9
-                if "перенос" not in reason and "позже" not in reason:
-                    reason = (reason + "; перенос обсуждения").strip("; ").strip()
-                if not action or action.lower().startswith("свяж"):
-                    action = "Запланируйте слот на следующей неделе и закрепите повестку письмом."
-            out = {"score": round(score, 2), "level": level, "reason": reason, "action": action}
+            out = _finalize_assessment(_extract_json_block(raw), sem_triggers)
+            parsed = True
         except Exception:
             # безопасный фоллбэк
-            out = {"score": 1.0, "level": "yellow", "reason": "fallback: не удалось распарсить ответ",
-                   "action": "Связаться с клиентом"}
+            out = dict(FALLBACK_ASSESSMENT)
+            parsed = False
 
-        _CACHE[key] = out
+        # фоллбэк на диск не пишем: после рестарта стоит спросить модель ещё раз
+        _cache_put(key, out, persist=parsed)
         return out
 
+    def assess_risk_llm_batch(self, features_list: List[Dict[str, Any]],
+                              batch_size: Optional[int] = None) -> List[dict]:
+        """
+        То же, что assess_risk_llm, но для списка сделок: промахи кэша уходят в LLM пачками
+        по batch_size в одном промпте (ответ — JSON-массив в том же порядке).
+        Если ответ пачки не разобрался — эти сделки оцениваются по одной.
+        Возвращает результаты в порядке features_list.
+        """
+        batch_size = batch_size or SETTINGS.llm_batch_size
+        results: List[Optional[dict]] = [None] * len(features_list)
+        pending = []  # (index, guarded_feats, sem_triggers, key)
+        for i, features in enumerate(features_list):
+            guarded_feats, sem_triggers = _prepare_features(features)
+            ruled = _rule_based_assessment(features, sem_triggers)
+            if ruled is not None:
+                results[i] = ruled
+                continue
+            key = _cache_key(guarded_feats)
+            cached = _cache_get(key)
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append((i, guarded_feats, sem_triggers, key))
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            outs = self._assess_chunk(chunk) if len(chunk) > 1 else None
+            if outs is None:
+                for i, *_ in chunk:
+                    results[i] = self.assess_risk_llm(features_list[i])
+                continue
+            for (i, _, _, key), out in zip(chunk, outs):
+                _cache_put(key, out)
+                results[i] = out
+        return results
+
+    def _assess_chunk(self, chunk: list) -> Optional[List[dict]]:
+        """Один промпт на пачку сделок. None — ответ не удалось сопоставить со входом."""
+        items = [guarded_feats for _, guarded_feats, _, _ in chunk]
+        prompt = f"""
+{RISK_RULES}
+На вход дан JSON-массив сделок. Оцени КАЖДУЮ сделку независимо.
+Верни СТРОГО JSON-массив той же длины и в том же порядке, без лишнего текста.
+Объяснение и действие должны быть на русском языке.
+
+[
+  {{
+    "deal_id": "<deal_id из входа>",
+    "level": "green"|"yellow"|"red",
+    "reason": "<краткая причина, 1-2 предложения>",
+    "action": "<следующий шаг, 1 предложение>"
+  }}
+]
+
+Сделки:
+{json.dumps(items)}
+"""
+        payload = {"model": self.model, "messages": [{"role": "user", "content": prompt}], "stream": self.stream}
+        data = self._post(payload, json_opener="[")
+        raw = data["choices"][0]["message"]["content"]
+
+        try:
+            arr = _extract_json_array(raw)
+            if len(arr) != len(chunk):
+                return None
+            outs = []
+            for obj, (_, guarded_feats, sem_triggers, _) in zip(arr, chunk):
+                if str(obj.get("deal_id", guarded_feats["deal_id"])) != str(guarded_feats["deal_id"]):
+                    return None
+                outs.append(_finalize_assessment(obj, sem_triggers))
+            return outs
+        except Exception:
+            return None
+
     def draft_followup(self, client_name: str, reason: str, last_message_text: str) -> str:
         """
         Короткий follow-up (4–6 предложений) под причину риска. На русском, деловой тон.
@@ -0,0 +1,26 @@
+from __future__ import annotations
+import threading, time
+
+
+class RateLimiter:
+    """
+    Потокобезопасный ограничитель частоты: не больше rate вызовов в секунду на все потоки.
+    Старты запросов разносятся равномерно (шаг 1/rate), поэтому пул потоков не упирается в 429.
+    rate <= 0 — без ограничений.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
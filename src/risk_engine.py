@@ -1,7 +1,9 @@
 from __future__ import annotations
-from datetime import datetime
+import re
+from datetime import date
 from dateutil import parser as dtparser
-from typing import Optional
+from typing import Optional, Union
+import numpy as np
 import pandas as pd
 from .config import SETTINGS
 
@@ -16,6 +18,17 @@ STAGE_THRESHOLDS = {
 NEGATIVE_KEYWORDS = [
     "дорого", "подождем", "выбрали другого", "неинтересно", "откажемся", "позже",
 ]
+# все ключевые фразы одним регэкспом: текст просматривается один раз, а не по разу на каждую фразу
+_NEGATIVE_RE = re.compile("|".join(map(re.escape, NEGATIVE_KEYWORDS)))
+
+TONES = ["negative", "neutral", "positive"]
+
+# Weights (tuneable)
+W_STALE = 0.6
+W_STAGE = 0.5
+W_TONE_NEG = 0.8
+W_TONE_POS = -0.3
+W_KEYWORD = 0.4
 
 
 class RiskResult:
@@ -24,26 +37,31 @@ class RiskResult:
         self.level = level
         self.explanation = explanation
 
-def days_since(date_str: str) -> int:
-    dt = dtparser.parse(date_str)
-    # naive -> treat as local
-    now = datetime.now()
-    return (now - dt).days
+def _parse_date(date_str: str) -> date:
+    # normalize_to_df отдаёт yyyy-mm-dd — это разбирается fromisoformat; dateutil только для прочих форматов
+    try:
+        return date.fromisoformat(date_str)
+    except ValueError:
+        return dtparser.parse(date_str).date()
+
+def days_since(date_str: str, today: Optional[date] = None) -> int:
+    # naive -> treat as local; today передаём снаружи, чтобы не дёргать часы на каждую строку
+    return ((today or date.today()) - _parse_date(date_str)).days
 
-def stage_stall_days(stage: str, last_stage_change_date: Optional[str]) -> int:
+def stage_stall_days(stage: str, last_stage_change_date: Optional[str], today: Optional[date] = None) -> int:
     if not last_stage_change_date:
         return 0
-    return days_since(last_stage_change_date)
+    return days_since(last_stage_change_date, today)
 
 def compute_risk_row(row: pd.Series, tone: str) -> RiskResult:
-    # Weights (tuneable)
-    W_STALE = 0.6
-    W_STAGE = 0.5
-    W_TONE_NEG = 0.8
-    W_TONE_POS = -0.3
+    # поля строки читаем один раз: Series.get на каждое обращение заметно дороже локальной переменной
+    stage = row.get("stage", "Переговоры")
+    last_change = row.get("last_stage_change_date")
+    text = (row.get("last_message_text", "") or "").lower()
 
-    d_stale = days_since(row["last_contact_date"])
-    d_stage = stage_stall_days(row.get("last_stage_change_date", None), row.get("last_stage_change_date", None))
+    today = date.today()
+    d_stale = days_since(row["last_contact_date"], today)
+    d_stage = stage_stall_days(stage, last_change, today)
 
     score = 0.0
     reasons = []
@@ -57,7 +75,6 @@ def compute_risk_row(row: pd.Series, tone: str) -> RiskResult:
         reasons.append(f"нет ответа {d_stale} дней")
 
     # Stage stall
-    stage = row.get("stage", "Переговоры")
     thr = STAGE_THRESHOLDS.get(stage, 10)
     if d_stage and d_stage > thr:
         score += W_STAGE * 1.5
@@ -72,9 +89,8 @@ def compute_risk_row(row: pd.Series, tone: str) -> RiskResult:
         reasons.append("позитивный тон последнего сообщения")
 
     # Keyword heuristics
-    text = (row.get("last_message_text", "") or "").lower()
-    if any(kw in text for kw in NEGATIVE_KEYWORDS):
-        score += 0.4
+    if _NEGATIVE_RE.search(text):
+        score += W_KEYWORD
         reasons.append("обнаружены триггерные фразы (напр. 'дорого', 'позже')")
 
     # Bucketize
@@ -87,3 +103,76 @@ def compute_risk_row(row: pd.Series, tone: str) -> RiskResult:
 
     explanation = "; ".join(reasons) if reasons else "риски не выявлены"
     return RiskResult(score=round(score, 2), level=level, explanation=explanation)
+
+
+def compute_risk_df(df: pd.DataFrame, tone: Union[str, pd.Series]) -> pd.DataFrame:
+    """
+    То же, что compute_risk_row, но сразу для всего фрейма (векторно, без цикла по строкам).
+    tone — строка для всех сделок или Series, выровненная по df.index.
+    Возвращает фрейм с колонками score, level, explanation (индекс как у df).
+    """
+    idx = df.index
+    today = pd.Timestamp(date.today())
+    tone = tone if isinstance(tone, pd.Series) else pd.Series(tone, index=idx)
+
+    def _parse(v) -> pd.Timestamp:
+        try:
+            return pd.Timestamp(_parse_date(v))
+        except (TypeError, ValueError, OverflowError):
+            return pd.NaT
+
+    def _days(s: pd.Series) -> np.ndarray:
+        # календарные дни, как в days_since; неразбираемое/пустое -> -1 (порогов не пересекает)
+        parsed = pd.to_datetime(s, format="ISO8601", errors="coerce")
+        # не-ISO строки (напр. "01.01.2020") разбираем тем же фоллбэком, что и compute_risk_row
+        other = parsed.isna() & s.notna() & s.astype(str).str.strip().ne("")
+        if other.any():
+            parsed = parsed.astype(object)
+            parsed[other] = s[other].map(_parse)
+            parsed = pd.to_datetime(parsed, errors="coerce")
+        days = (today - parsed.dt.normalize()).dt.days
+        return days.fillna(-1).to_numpy(dtype=np.int32)
+
+    # дальше считаем на плотных numpy-массивах фиксированного типа, а не на Series с object-ячейками
+    d_stale = _days(df["last_contact_date"])
+    stage_changed = df["last_stage_change_date"] if "last_stage_change_date" in df else pd.Series(None, index=idx)
+    d_stage = _days(stage_changed)
+    stage = (df["stage"] if "stage" in df else pd.Series("Переговоры", index=idx)).fillna("").astype(str)
+    # порог стадии — один проход map по колонке вместо dict.get на строку
+    thr = stage.map(STAGE_THRESHOLDS).fillna(10).to_numpy(dtype=np.int16)
+    tone_code = pd.Categorical(tone, categories=TONES).codes.astype(np.int8)  # -1 = неизвестный тон
+    text = df["last_message_text"].fillna("").astype(str).str.lower() if "last_message_text" in df \
+        else pd.Series("", index=idx)
+
+    stale = d_stale > 7
+    stall = (d_stage > thr) & (d_stage > 0)
+    neg, pos = tone_code == TONES.index("negative"), tone_code == TONES.index("positive")
+    kw_hit = text.str.contains(_NEGATIVE_RE).to_numpy(dtype=bool)
+
+    # score остаётся float64: во float32 сумма весов у границ (0.7, 1.5) может уйти в соседнюю корзину
+    score = pd.Series(
+        W_STALE * np.select([d_stale > 14, stale], [2, 1], 0)
+        + W_STAGE * 1.5 * stall
+        + W_TONE_NEG * neg
+        + W_TONE_POS * pos
+        + W_KEYWORD * kw_hit,
+        index=idx,
+    )
+    level = pd.cut(score, [-np.inf, 0.7, 1.5, np.inf], right=False, labels=["green", "yellow", "red"])
+
+    # причины в том же порядке, что в compute_risk_row: "; причина" или "" -> склейка -> срез ведущего "; "
+    def _const(msg: str, mask: np.ndarray) -> pd.Series:
+        return pd.Series(msg, index=idx).where(mask, "")
+
+    parts = [
+        ("; нет ответа " + pd.Series(d_stale, index=idx).astype(str) + " дней").where(stale, ""),
+        ("; застряла в стадии '" + stage + "' " + pd.Series(d_stage, index=idx).astype(str)
+         + " дней (порог " + pd.Series(thr, index=idx).astype(str) + ")").where(stall, ""),
+        _const("; негативный тон последнего сообщения", neg),
+        _const("; позитивный тон последнего сообщения", pos),
+        _const("; обнаружены триггерные фразы (напр. 'дорого', 'позже')", kw_hit),
+    ]
+    explanation = sum(parts[1:], parts[0]).str[2:]
+    explanation = explanation.where(explanation.ne(""), "риски не выявлены")
+
+    return pd.DataFrame({"score": score.round(2), "level": level, "explanation": explanation}, index=idx)